@@ -1,8 +1,15 @@
+import asyncio
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from operator import itemgetter
 from dotenv import load_dotenv
-from io import BytesIO
-import pandas as pd
 from telegram import Update
 from telegram.ext import Application, MessageHandler, filters, ContextTypes
 
@@ -12,27 +19,122 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise ValueError("❌ BOT_TOKEN не задан в .env")
+
+REQUIRED_COLS = [
+    '"source_NTTM_DB"[3ЛТП_Признак]',
+    'Уровень',
+    'Исключить ЦЭ',
+    'Исключить по услуге',
+    'Тип услуги',
+    'Нарушение SLA',
+    'Нарушение SLA без ожидания клиента',
+    'МРФ подключения',
+    'РФ подключения'
+]
+
+# Строковые столбцы, по которым идут сравнения и groupby: храним как category
+CATEGORY_COLS = [
+    'Уровень',
+    'МРФ подключения',
+    'РФ подключения',
+    'Тип услуги',
+    'Исключить ЦЭ',
+    'Исключить по услуге'
+]
+
+# Уровни, которые попадают в раздел «Прочие»
+OTHER_LEVELS = frozenset(['Бронзовый', 'Золотой', 'Серебряный'])
+
+# Шапка отчёта по одному МРФ; блоки РФ присоединяются через join("\n")
+REPORT_HEADER = "📊 Отчёт по SLA (3ЛТП), норматив: 87.0%\n\n📍 {mrf_name}\n"
+
+# Блок отчёта по одному уровню; пустая строка-разделитель добавляется при join
+LEVEL_TEMPLATE = (
+    "SLA 3лтп {level_name}\n"
+    "В срок: {on_time}\n"
+    "Всего: {total}\n"
+    "SLA: {sla_pct}% {status}\n"
+)
+NEED_TT_TEMPLATE = "Нужно до норматива: {need_tt}\n"
+
+# Пул для разбора Excel: создаётся при первом файле (см. get_executor), а не при импорте —
+# иначе каждый воркер, заново импортируя bot.py, строил бы свой ненужный пул
+EXECUTOR = None
+
+# Готовые отчёты по (хэш, размер) файла: повторная загрузка того же файла не пересчитывается
+REPORT_CACHE = OrderedDict()
+REPORT_CACHE_SIZE = 64
 
 
 # =====================================================================
 # Вспомогательные функции
 # =====================================================================
 
+# pandas и numpy нужны только воркерам пула, поэтому импортируются внутри
+# функций: основной процесс бота стартует быстрее и не держит их в памяти.
+
 def normalize_sla_column(df):
-    """Конвертирует 'Нарушение SLA' в 0/1. Пустые → 1 (нарушение)."""
-    return pd.to_numeric(df['Нарушение SLA'], errors='coerce').fillna(1)
+    """Конвертирует 'Нарушение SLA' в 0/1 (int8). Пустые, нечисловые и любые ненулевые → 1 (нарушение)."""
+    import numpy as np
+    import pandas as pd
+
+    sla = df['Нарушение SLA']
+    # Поэлементный разбор нужен только для object-столбца с текстом
+    if not pd.api.types.is_numeric_dtype(sla):
+        sla = pd.to_numeric(sla, errors='coerce')
+    # Сначала флаг, потом сужение: прямой astype(int8) превратил бы 0.5 или 256 в 0
+    return sla.fillna(1).ne(0).astype(np.int8)
 
 
 def fix_ott(df):
     """Для ОТТ подменяет 'Нарушение SLA' значением из 'Нарушение SLA без ожидания клиента'."""
-    mask_ott = df["Тип услуги"] == "ОТТ"
-    df.loc[mask_ott, "Нарушение SLA"] = df.loc[mask_ott, "Нарушение SLA без ожидания клиента"] \
-        .apply(lambda x: 1 if x == 1 else 0)
+    import numpy as np
+
+    mask_ott = (df["Тип услуги"] == "ОТТ").to_numpy()
+    vals = df["Нарушение SLA без ожидания клиента"].to_numpy()
+    df.loc[mask_ott, "Нарушение SLA"] = (vals[mask_ott] == 1).astype(np.int8)
     return df
 
 
+def aggregate_sla(df):
+    """
+    Считает 'В срок' и 'Всего' по (МРФ, РФ, уровень) за один проход groupby.
+    Для каждой пары МРФ/РФ в результате есть оба уровня, пустые — с нулями.
+    """
+    import numpy as np
+    import pandas as pd
+
+    levels = df['Уровень'].cat.categories
+    other_codes = {levels.get_loc(level) for level in OTHER_LEVELS if level in levels}
+
+    on_time = df['Нарушение SLA'].eq(0).astype(np.int8)
+
+    # Раздел отчёта как category; строки вне уровней — в служебную категорию '',
+    # чтобы их МРФ/РФ не выпали из groupby (в отчёте они есть, с нулями)
+    is_platinum = df['Уровень'].eq('Платиновый').to_numpy()
+    is_other = df['Уровень'].cat.codes.isin(other_codes).to_numpy()
+    bucket = pd.Series(
+        pd.Categorical.from_codes(np.where(is_platinum, 0, np.where(is_other, 1, 2)), ['Платина', 'Прочие', '']),
+        index=df.index,
+        name='bucket',
+    )
+
+    # on_time — флаг 0/1: size даёт «Всего», sum — «В срок», обе за один проход
+    agg = on_time.groupby(
+        [df['МРФ подключения'], df['РФ подключения'], bucket], observed=True
+    ).agg(total='size', on_time='sum')
+    # Счётчики неотрицательные и заведомо меньше 2**32
+    agg = agg.astype(np.uint32)
+
+    # Служебная категория '' отбрасывается, недостающие уровни заполняются нулями
+    pairs = agg.index.droplevel('bucket').unique()
+    full_index = pd.MultiIndex.from_tuples(
+        [(mrf, rf, level) for mrf, rf in pairs for level in ('Платина', 'Прочие')],
+        names=agg.index.names,
+    )
+    return agg.reindex(full_index, fill_value=0)
+
+
 def calc_sla(total, on_time, norm=0.87):
     """
     Расчёт SLA и количества новых ТТ, необходимых для достижения норматива.
@@ -51,89 +153,181 @@ def calc_sla(total, on_time, norm=0.87):
     return sla_pct, x, "❌"
 
 
-# =====================================================================
-# Обработчик Excel
-# =====================================================================
+def format_level(level_name, total, on_time):
+    """Формирует текстовый блок отчёта по одному уровню."""
+    sla_pct, need_tt, status = calc_sla(total, on_time)
+    text = LEVEL_TEMPLATE.format(
+        level_name=level_name, on_time=on_time, total=total, sla_pct=sla_pct, status=status
+    )
+    if need_tt > 0:
+        text += NEED_TT_TEMPLATE.format(need_tt=need_tt)
+    return text
 
-async def handle_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    doc = update.message.document
 
-    if not doc.file_name.lower().endswith(".xlsx"):
-        await update.message.reply_text("Пожалуйста, отправьте файл в формате .xlsx")
-        return
+def iter_rf_blocks(records):
+    """Выдаёт заголовки РФ и блоки уровней из записей (МРФ, РФ, уровень, всего, в срок)."""
+    for rf_name, rows in itertools.groupby(records, key=itemgetter(1)):
+        yield f"📌 {rf_name}\n"
+        for _, _, level_name, total, on_time in rows:
+            yield format_level(level_name, total, on_time)
+
+
+def file_key(path):
+    """Ключ кэша отчётов: blake2b-хэш содержимого файла и его размер."""
+    with open(path, "rb") as f:
+        digest = hashlib.file_digest(f, lambda: hashlib.blake2b(digest_size=16)).digest()
+    return digest, os.path.getsize(path)
+
 
-    file_bytes = BytesIO()
-    await (await doc.get_file()).download_to_memory(file_bytes)
-    file_bytes.seek(0)
+def get_executor():
+    """Возвращает пул процессов для разбора Excel, создавая его при необходимости."""
+    global EXECUTOR
+    if EXECUTOR is None:
+        # spawn, а не fork — родитель многопоточный (event loop, httpx)
+        EXECUTOR = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return EXECUTOR
+
+
+def drop_executor(executor):
+    """Закрывает сломанный пул; следующий get_executor() создаст новый."""
+    global EXECUTOR
+    # Пул мог уже пересоздать другой обработчик — новый не трогаем
+    if EXECUTOR is executor:
+        EXECUTOR = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def shutdown_executor(app):
+    """Останавливает пул процессов при завершении бота."""
+    global EXECUTOR
+    if EXECUTOR is not None:
+        executor, EXECUTOR = EXECUTOR, None
+        await asyncio.to_thread(executor.shutdown, cancel_futures=True)
+
+
+async def send_reports(message, reports):
+    """
+    Отправляет отчёты по одному. Все они уходят в один чат: Telegram ограничивает
+    частоту сообщений в чат (~1 в секунду), а МРФ должны приходить по порядку.
+    """
+    for text in reports:
+        await message.reply_text(text)
+
+
+# =====================================================================
+# Построение отчётов (выполняется в отдельном процессе)
+# =====================================================================
+
+def build_reports(path):
+    """
+    Читает Excel-выгрузку и строит текстовые отчёты по каждому МРФ.
+    Возвращает список сообщений для отправки; при ошибке — одно сообщение с её описанием.
+    """
+    import pandas as pd
 
     try:
-        df = pd.read_excel(file_bytes, header=2)
+        df = pd.read_excel(
+            path,
+            header=2,
+            engine="calamine",
+            usecols=lambda col: col in REQUIRED_COLS,
+        )
     except Exception as e:
         logger.error(f"Ошибка чтения Excel: {e}")
-        await update.message.reply_text("❌ Не удалось прочитать Excel-файл.")
-        return
+        return ["❌ Не удалось прочитать Excel-файл."]
 
-    required_cols = [
-        '"source_NTTM_DB"[3ЛТП_Признак]',
-        'Уровень',
-        'Исключить ЦЭ',
-        'Исключить по услуге',
-        'Тип услуги',
-        'Нарушение SLA',
-        'Нарушение SLA без ожидания клиента',
-        'МРФ подключения',
-        'РФ подключения'
-    ]
-    if not all(col in df.columns for col in required_cols):
-        await update.message.reply_text("❌ В файле отсутствуют необходимые столбцы.")
-        return
+    if not all(col in df.columns for col in REQUIRED_COLS):
+        return ["❌ В файле отсутствуют необходимые столбцы."]
 
-    if "dwh" in doc.file_name.lower() or "sla" in doc.file_name.lower():
-        df = fix_ott(df)
-    else:
-        await update.message.reply_text("ℹ️ Имя файла должно содержать 'dwh' или 'sla'.")
-        return
+    for col in CATEGORY_COLS:
+        df[col] = df[col].astype('category')
+
+    df = fix_ott(df)
 
     base_mask = (
         (df['"source_NTTM_DB"[3ЛТП_Признак]'] == 1) &
         (df['Исключить ЦЭ'] == 'Без признака ЦЭ') &
         (df['Исключить по услуге'] == 'Расчетные услуги')
     )
-    df = df[base_mask].copy()
+    # Отбор по маске и так возвращает новый фрейм, лишний .copy() не нужен
+    df = df[base_mask]
     if df.empty:
-        await update.message.reply_text("ℹ️ После фильтрации данных нет.")
-        return
+        return ["ℹ️ После фильтрации данных нет."]
+
+    # В pandas 2.x результат отбора по маске помечен как производный (_is_copy), и запись
+    # столбца даёт SettingWithCopyWarning; исходный фрейм дальше не нужен, так что это безопасно
+    with pd.option_context('mode.chained_assignment', None):
+        df['Нарушение SLA'] = normalize_sla_column(df)
+    agg = aggregate_sla(df)
 
     # =====================================================================
     # Формирование отчёта в текстовом формате
     # =====================================================================
 
-    for mrf, mrf_df in df.groupby(['МРФ подключения']):
-        mrf_name = mrf if isinstance(mrf, str) else mrf[0]
-        report_lines = [f"📊 Отчёт по SLA (3ЛТП), норматив: 87.0%\n"]
-        report_lines.append(f"📍 {mrf_name}\n")
+    # Записи отсортированы по МРФ и РФ, поэтому группы идут подряд
+    records = agg.reset_index().itertuples(index=False, name=None)
+    rows_by_mrf = {mrf_name: list(rows) for mrf_name, rows in itertools.groupby(records, key=itemgetter(0))}
+
+    # Отчёт идёт по всем МРФ: у МРФ, где все РФ пустые, в agg строк нет, но шапка отправляется
+    mrf_names = df['МРФ подключения'].dropna().unique().sort_values()
+    reports = [
+        "\n".join(itertools.chain(
+            [REPORT_HEADER.format(mrf_name=mrf_name)],
+            iter_rf_blocks(rows_by_mrf.get(mrf_name, [])),
+        ))
+        for mrf_name in mrf_names
+    ]
+    return reports or ["ℹ️ После фильтрации данных нет."]
+
 
-        for rf, group_df in mrf_df.groupby(['РФ подключения']):
-            rf_name = rf if isinstance(rf, str) else rf[0]
-            report_lines.append(f"📌 {rf_name}\n")
+# =====================================================================
+# Обработчик Excel
+# =====================================================================
 
-            for level_name, df_level in [("Платина", group_df[group_df['Уровень'] == 'Платиновый']),
-                                         ("Прочие", group_df[group_df['Уровень'].isin(['Бронзовый', 'Золотой', 'Серебряный'])])]:
-                df_level['Нарушение SLA'] = normalize_sla_column(df_level)
-                total = len(df_level)
-                on_time = (df_level['Нарушение SLA'] == 0).sum()
-                sla_pct, need_tt, status = calc_sla(total, on_time)
+async def handle_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    doc = update.message.document
 
-                report_lines.append(f"SLA 3лтп {level_name}")
-                report_lines.append(f"В срок: {on_time}")
-                report_lines.append(f"Всего: {total}")
-                report_lines.append(f"SLA: {sla_pct}% {status}")
-                if need_tt > 0:
-                    report_lines.append(f"Нужно до норматива: {need_tt}")
-                report_lines.append("")  # пустая строка между уровнями
+    # Имя проверяем до скачивания, чтобы не тянуть заведомо неподходящие файлы
+    file_name = doc.file_name.lower()
+    if not file_name.endswith(".xlsx"):
+        await update.message.reply_text("Пожалуйста, отправьте файл в формате .xlsx")
+        return
+    if "dwh" not in file_name and "sla" not in file_name:
+        await update.message.reply_text("ℹ️ Имя файла должно содержать 'dwh' или 'sla'.")
+        return
 
-        report_text = "\n".join(report_lines)
-        await update.message.reply_text(report_text)
+    # PTB 20.7 не стримит загрузку: download_to_drive получает тело файла целиком в память
+    # и синхронно пишет его на диск. Выигрыш лишь в том, что буфер освобождается до разбора,
+    # а воркеру передаётся путь, а не байты.
+    with tempfile.NamedTemporaryFile(suffix=".xlsx") as tmp:
+        await (await doc.get_file()).download_to_drive(tmp.name)
+
+        # Хэширование читает весь файл — не блокируем им event loop
+        key = await asyncio.to_thread(file_key, tmp.name)
+        if key in REPORT_CACHE:
+            REPORT_CACHE.move_to_end(key)
+            reports = REPORT_CACHE[key]
+        else:
+            # pandas блокирует event loop и держит GIL — считаем в пуле процессов
+            loop = asyncio.get_running_loop()
+            executor = get_executor()
+            try:
+                reports = await loop.run_in_executor(executor, build_reports, tmp.name)
+            except BrokenProcessPool:
+                # Воркер погиб (например, OOM на большом файле): без замены пул сломан навсегда
+                logger.exception("Пул процессов сломан, пересоздаём")
+                drop_executor(executor)
+                await update.message.reply_text("❌ Не удалось прочитать Excel-файл.")
+                return
+
+            REPORT_CACHE[key] = reports
+            if len(REPORT_CACHE) > REPORT_CACHE_SIZE:
+                REPORT_CACHE.popitem(last=False)
+
+    await send_reports(update.message, reports)
 
 
 # =====================================================================
@@ -141,7 +335,10 @@ async def handle_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # =====================================================================
 
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    if not BOT_TOKEN:
+        raise ValueError("❌ BOT_TOKEN не задан в .env")
+
+    app = Application.builder().token(BOT_TOKEN).post_shutdown(shutdown_executor).build()
     app.add_handler(MessageHandler(filters.Document.ALL, handle_excel))
 
     logger.info("Бот запущен...")